@@ -3,8 +3,9 @@ import re
 import uuid
 import io
 import zipfile
-from dataclasses import dataclass
-from datetime import datetime, timedelta
+from dataclasses import dataclass, field
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 import streamlit as st
 
@@ -15,6 +16,41 @@ MAX_LINES = 2000
 MAX_FIELD_LEN = 200
 MAX_UPLOAD_BYTES = 200000
 CONTROL_CHAR_RE = re.compile(r"[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]")
+PAREN_RE = re.compile(r'[（(]([^（）()]+)[)）]')
+IATA_CODE_RE = re.compile(r'\b([A-Z]{3})\b')
+ROUTE_RE = re.compile(r'(.+?)(\d{1,2}:\d{2})発\s+(.+?)(\d{1,2}:\d{2})着')
+EMAIL_BLOCK_RE = re.compile(
+    r'(\d{4})年(\d{1,2})月(\d{1,2})日[^\n]*?JAL(\d{1,4})便[^\n]*\n'
+    r'\s*([^\n]*発[^\n]*着[^\n]*)'
+    r'(?:\n\s*(座席[^\n]*))?'
+)
+SEAT_CLASS_RE = re.compile(r'クラス\s*([A-Zぁ-んァ-ヶ一-龠A-Za-z]+)')
+SEAT_NO_RE = re.compile(r'座席番号：?([0-9A-Z]{1,4})')
+DATE_RE = re.compile(r'(\d{4})年(\d{1,2})月(\d{1,2})日')
+TIME_PREFIX_RE = re.compile(r'^(\d{1,2}:\d{2})\s*(.+)')
+HP_CLASS_RE = re.compile(r'クラス[：:]\s*(.+)')
+HP_FLIGHT_RE = re.compile(r'便名[：:]\s*JAL(\d{1,4})(?!\d)')
+ICS_HEADER = (
+    "BEGIN:VCALENDAR\n"
+    "PRODID:-//JAL Flight Parser//JP\n"
+    "VERSION:2.0\n"
+    "CALSCALE:GREGORIAN\n"
+    "METHOD:PUBLISH\n"
+)
+ICS_FOOTER = "END:VCALENDAR\n"
+VEVENT_TEMPLATE = (
+    "BEGIN:VEVENT\n"
+    "UID:{0}\n"
+    "DTSTAMP:{1}\n"
+    "DTSTART;TZID=Asia/Tokyo:{2}\n"
+    "DTEND;TZID=Asia/Tokyo:{3}\n"
+    "SUMMARY:{4}\n"
+    "LOCATION:{5}\n"
+    "DESCRIPTION:{6}\n"
+    "END:VEVENT\n"
+)
+# CR は内容行を分断するので削除する
+ICS_ESCAPE_TABLE = str.maketrans({"\\": "\\\\", "\n": "\\n", "\r": "", ";": "\\;", ",": "\\,"})
 
 AIRPORT_CODE_MAP = {
     "東京(羽田)": "HND", "東京（羽田）": "HND", "羽田": "HND",
@@ -25,16 +61,18 @@ AIRPORT_CODE_MAP = {
     "名古屋(中部)": "NGO", "名古屋（中部）": "NGO", "中部": "NGO"
 }
 
+@lru_cache(maxsize=1024)
 def guess_airport_code(name: str) -> str:
-    if name in AIRPORT_CODE_MAP:
-        return AIRPORT_CODE_MAP[name]
-    paren = re.search(r'[（(]([^（）()]+)[)）]', name)
+    code = AIRPORT_CODE_MAP.get(name)
+    if code:
+        return code
+    paren = PAREN_RE.search(name)
     if paren:
-        inside = paren.group(1)
-        m = re.search(r'\b([A-Z]{3})\b', inside)
+        # 括弧内だけを検索(部分文字列は作らない)
+        m = IATA_CODE_RE.search(name, paren.start(1), paren.end(1))
         if m:
             return m.group(1)
-    m2 = re.search(r'\b([A-Z]{3})\b', name)
+    m2 = IATA_CODE_RE.search(name)
     if m2:
         return m2.group(1)
     letters = ''.join(ch for ch in name if ch.isalpha() and 'A' <= ch.upper() <= 'Z')
@@ -42,7 +80,7 @@ def guess_airport_code(name: str) -> str:
         return letters[:3].upper()
     return name
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Flight:
     year: int
     month: int
@@ -54,39 +92,43 @@ class Flight:
     arr_time: str
     seat_class: str | None = None
     seat_no: str | None = None
-
-    @property
-    def dep_dt(self):
-        return datetime(self.year, self.month, self.day,
-                        int(self.dep_time[:2]), int(self.dep_time[3:]), tzinfo=JST)
-
-    @property
-    def arr_dt(self):
-        arr = datetime(self.year, self.month, self.day,
-                       int(self.arr_time[:2]), int(self.arr_time[3:]), tzinfo=JST)
-        if arr < self.dep_dt:
-            arr += timedelta(days=1)
-        return arr
-
-    def dep_code(self):
-        return guess_airport_code(self.dep_name)
-
-    def arr_code(self):
-        return guess_airport_code(self.arr_name)
+    # 以下は __post_init__ で一度だけ計算する
+    dep_code: str = field(init=False, repr=False, compare=False)
+    arr_code: str = field(init=False, repr=False, compare=False)
+    dep_dt: datetime = field(init=False, repr=False, compare=False)
+    arr_dt: datetime = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # frozen なので object.__setattr__ で派生値を設定する
+        object.__setattr__(self, "dep_code", guess_airport_code(self.dep_name))
+        object.__setattr__(self, "arr_code", guess_airport_code(self.arr_name))
+        dep_h, dep_m = int(self.dep_time[:-3]), int(self.dep_time[-2:])
+        arr_h, arr_m = int(self.arr_time[:-3]), int(self.arr_time[-2:])
+        dep = datetime(self.year, self.month, self.day, dep_h, dep_m, tzinfo=JST)
+        # 到着が出発より前なら翌日着(JSTには夏時間がないので分の差で計算できる)
+        minutes = (arr_h * 60 + arr_m - dep_h * 60 - dep_m) % (24 * 60)
+        object.__setattr__(self, "dep_dt", dep)
+        object.__setattr__(self, "arr_dt", dep + timedelta(minutes=minutes))
 
 def normalize(text: str) -> str:
     return text.replace("\u3000", " ").replace("\r", "").strip()
 
+def prepare_text(raw: str) -> tuple[str, list[str]]:
+    """正規化済みテキストと空行を除いた行リストを返す"""
+    text = normalize(raw)
+    return text, [s for l in text.split("\n") if (s := l.strip())]
+
 def sanitize_user_text(text: str) -> str:
     if not text:
         return ""
+    # 制御文字が無ければ re.sub は元の文字列をそのまま返す
     text = CONTROL_CHAR_RE.sub("", text)
     if len(text) > MAX_INPUT_CHARS:
         text = text[:MAX_INPUT_CHARS]
-    lines = text.split("\n")
-    if len(lines) > MAX_LINES:
-        lines = lines[:MAX_LINES]
-    return "\n".join(lines)
+    # 行数が上限以内なら分割・再結合しない
+    if text.count("\n") < MAX_LINES:
+        return text
+    return "\n".join(text.split("\n", MAX_LINES)[:MAX_LINES])
 
 def trim_field(value: str) -> str:
     value = CONTROL_CHAR_RE.sub("", value).strip()
@@ -94,88 +136,56 @@ def trim_field(value: str) -> str:
         value = value[:MAX_FIELD_LEN]
     return value
 
-def escape_ics_text(value: str) -> str:
-    value = trim_field(value)
-    return (
-        value.replace("\\", "\\\\")
-             .replace("\n", "\\n")
-             .replace(";", "\\;")
-             .replace(",", "\\,")
-    )
-
-def extract_location_and_time(segment: str):
-    m = re.match(r'(.+?)(\d{1,2}:\d{2})発', segment.strip())
-    if not m:
-        return None, None
-    name = m.group(1).strip()
-    time = m.group(2)
-    return name, time
+def escape_clean_ics_text(value: str) -> str:
+    """サニタイズ済みの値から組み立てた文字列をエスケープする"""
+    return value.translate(ICS_ESCAPE_TABLE)
 
 def is_valid_time(value: str) -> bool:
-    if not re.match(r"^\d{1,2}:\d{2}$", value or ""):
+    if not value or not 4 <= len(value) <= 5 or value[-3] != ":":
         return False
-    h, m = value.split(":")
-    return 0 <= int(h) <= 23 and 0 <= int(m) <= 59
+    h, m = value[:-3], value[-2:]
+    if not (h.isdecimal() and m.isdecimal()):
+        return False
+    return int(h) <= 23 and int(m) <= 59
 
-def parse_flights_email(raw: str):
-    """メールフォーマットのパーサー"""
-    text = normalize(raw)
-    lines = [l.strip() for l in text.split("\n") if l.strip()]
+def parse_flights_email(text: str):
+    """メールフォーマットのパーサー(text は prepare_text で正規化済み)"""
     flights = []
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-        if "JAL" in line and "便" in line and "年" in line and "月" in line and "日" in line:
-            md = re.search(r'(\d{4})年(\d{1,2})月(\d{1,2})日.*?JAL(\d+)便', line)
-            if not md:
-                i += 1
-                continue
-            year, month, day, flight_no = map(int, md.group(1,2,3,4))
-            route_line = lines[i+1] if i + 1 < len(lines) else ""
-            dep_name = dep_time = arr_name = arr_time = None
-            if route_line and ("発" in route_line and "着" in route_line):
-                parts = re.split(r'\s{2,}|\t+', route_line)
-                parts = [p for p in parts if p]
-                if len(parts) < 2:
-                    parts = [route_line]
-                if len(parts) >= 2:
-                    dep_name, dep_time = extract_location_and_time(parts[0])
-                    arr_m = re.match(r'(.+?)(\d{1,2}:\d{2})着', parts[1])
-                    if arr_m:
-                        arr_name = arr_m.group(1).strip()
-                        arr_time = arr_m.group(2)
-            seat_class = seat_no = None
-            if i + 2 < len(lines) and lines[i+2].startswith("座席"):
-                seat_line = lines[i+2]
-                sc = re.search(r'クラス\s*([A-Zぁ-んァ-ヶ一-龠A-Za-z]+)', seat_line)
-                if sc:
-                    seat_class = sc.group(1).strip()
-                sn = re.search(r'座席番号：?([0-9A-Z]{1,4})', seat_line)
-                if sn:
-                    seat_no = sn.group(1).strip()
-            if all([dep_name, dep_time, arr_name, arr_time]) and is_valid_time(dep_time) and is_valid_time(arr_time):
-                flights.append(Flight(
-                    year, month, day, trim_field(str(flight_no)),
-                    trim_field(dep_name), dep_time, trim_field(arr_name), arr_time,
-                    trim_field(seat_class) if seat_class else None,
-                    trim_field(seat_no) if seat_no else None
-                ))
-            i += 1
-        else:
-            i += 1
+    # 日付・便名行 + 次の行(発着) + 任意の座席行 をまとめて検索
+    for md in EMAIL_BLOCK_RE.finditer(text):
+        year, month, day, flight_no = map(int, md.group(1,2,3,4))
+        route = ROUTE_RE.match(md.group(5).strip())
+        if not route:
+            continue
+        dep_name, dep_time, arr_name, arr_time = route.groups()
+        dep_name, arr_name = dep_name.strip(), arr_name.strip()
+        seat_class = seat_no = None
+        seat_line = md.group(6)
+        if seat_line:
+            sc = SEAT_CLASS_RE.search(seat_line)
+            if sc:
+                seat_class = sc.group(1).strip()
+            sn = SEAT_NO_RE.search(seat_line)
+            if sn:
+                seat_no = sn.group(1).strip()
+        if all([dep_name, dep_time, arr_name, arr_time]) and is_valid_time(dep_time) and is_valid_time(arr_time):
+            flights.append(Flight(
+                year, month, day, str(flight_no),
+                trim_field(dep_name), dep_time, trim_field(arr_name), arr_time,
+                trim_field(seat_class) if seat_class else None,
+                trim_field(seat_no) if seat_no else None
+            ))
     return flights
 
-def parse_flights_homepage(raw: str):
-    """JALホームページフォーマットのパーサー"""
-    text = normalize(raw)
-    lines = [l.strip() for l in text.split("\n") if l.strip()]
+def parse_flights_homepage(lines: list[str]):
+    """JALホームページフォーマットのパーサー(lines は prepare_text の行リスト)"""
     flights = []
     i = 0
     
     while i < len(lines):
         line = lines[i]
         # 日付行を探す: 2026年2月10日（火）
-        date_match = re.match(r'(\d{4})年(\d{1,2})月(\d{1,2})日', line)
+        date_match = DATE_RE.match(line)
         if date_match:
             year, month, day = map(int, date_match.groups())
             
@@ -190,36 +200,32 @@ def parse_flights_homepage(raw: str):
                 curr_line = lines[j]
                 
                 # 出発時刻と空港: 11:55東京 (羽田)
-                if not found_dep and re.match(r'^\d{1,2}:\d{2}', curr_line):
-                    dep_match = re.match(r'^(\d{1,2}:\d{2})(.+)', curr_line)
-                    if dep_match:
-                        dep_time = dep_match.group(1)
-                        dep_name = dep_match.group(2).strip()
-                        found_dep = True
-                        j += 1
-                        continue
+                if not found_dep and (dep_match := TIME_PREFIX_RE.match(curr_line)):
+                    dep_time = dep_match.group(1)
+                    dep_name = dep_match.group(2).strip()
+                    found_dep = True
+                    j += 1
+                    continue
                 
                 # 到着時刻と空港: 14:50 沖縄 (那覇) または 14:50沖縄 (那覇)
-                if found_dep and not arr_time and re.match(r'^\d{1,2}:\d{2}', curr_line):
-                    arr_match = re.match(r'^(\d{1,2}:\d{2})\s*(.+)', curr_line)
-                    if arr_match:
-                        arr_time = arr_match.group(1)
-                        arr_name = arr_match.group(2).strip()
+                if found_dep and not arr_time and (arr_match := TIME_PREFIX_RE.match(curr_line)):
+                    arr_time = arr_match.group(1)
+                    arr_name = arr_match.group(2).strip()
                 
                 # クラス: クラス： クラス J
                 if "クラス：" in curr_line or "クラス:" in curr_line:
-                    class_match = re.search(r'クラス[：:]\s*(.+)', curr_line)
+                    class_match = HP_CLASS_RE.search(curr_line)
                     if class_match:
                         seat_class = class_match.group(1).strip()
                 
                 # 便名：JAL915
                 if "便名：" in curr_line or "便名:" in curr_line:
-                    flight_match = re.search(r'便名[：:]\s*JAL(\d+)', curr_line)
+                    flight_match = HP_FLIGHT_RE.search(curr_line)
                     if flight_match:
                         flight_no = flight_match.group(1)
                 
                 # 次の日付行が来たら終了
-                if j > i + 1 and re.match(r'\d{4}年\d{1,2}月\d{1,2}日', curr_line):
+                if j > i + 1 and DATE_RE.match(curr_line):
                     break
                 
                 j += 1
@@ -227,7 +233,7 @@ def parse_flights_homepage(raw: str):
             # フライト情報が揃っていれば追加
             if all([dep_time, dep_name, arr_time, arr_name, flight_no]) and is_valid_time(dep_time) and is_valid_time(arr_time):
                 flights.append(Flight(
-                    year, month, day, trim_field(flight_no),
+                    year, month, day, flight_no,
                     trim_field(dep_name), dep_time, trim_field(arr_name), arr_time,
                     trim_field(seat_class) if seat_class else None, None
                 ))
@@ -239,28 +245,45 @@ def parse_flights_homepage(raw: str):
     
     return flights
 
-def parse_flights(raw: str):
+@st.cache_data(max_entries=32, show_spinner=False)
+def parse_flights(raw: str) -> list[Flight]:
     """両方のフォーマットを試してパース"""
     raw = sanitize_user_text(raw)
-    # メールフォーマットを試す
-    flights = parse_flights_email(raw)
+    # どちらのフォーマットも日付と "JAL" を含むので、無ければ解析しない
+    if "JAL" not in raw or "年" not in raw:
+        return []
+    text, lines = prepare_text(raw)
+    # 各フォーマットに必須の文字列で判定し、該当しないパーサーは実行しない
+    maybe_email = "発" in text and "着" in text
+    maybe_homepage = "便名：" in text or "便名:" in text
+    if not maybe_homepage:
+        return parse_flights_email(text) if maybe_email else []
+    if not maybe_email:
+        return parse_flights_homepage(lines)
+
+    # 両方の可能性がある場合はメールフォーマットを優先
+    flights = parse_flights_email(text)
     
     # 見つからなければホームページフォーマットを試す
     if not flights:
-        flights = parse_flights_homepage(raw)
+        flights = parse_flights_homepage(lines)
     
     return flights
 
-def to_ics(flight: Flight) -> str:
+def ics_dtstamp() -> str:
+    return datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+def to_ics(flight: Flight, dtstamp: str, uid: str) -> str:
     dep_dt = flight.dep_dt
     arr_dt = flight.arr_dt
-    dtstamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
     def fmt(dt): return dt.strftime("%Y%m%dT%H%M%S")
-    dep_code = flight.dep_code()
-    arr_code = flight.arr_code()
+    dep_code = flight.dep_code
+    arr_code = flight.arr_code
     def short(s): return s if len(s) <= 8 else s[:8]
-    summary = escape_ics_text(f"JAL{flight.flight_no} {short(dep_code)}->{short(arr_code)}")
-    location = escape_ics_text(f"{flight.dep_name} -> {flight.arr_name}")
+    # Flight の文字列フィールドはパース時に trim_field 済みか、正規表現で桁数制限済み(便名・時刻)。
+    # 改行(CR/LF)は escape_clean_ics_text が処理するので再サニタイズしない
+    summary = escape_clean_ics_text(f"JAL{flight.flight_no} {short(dep_code)}->{short(arr_code)}")
+    location = escape_clean_ics_text(f"{flight.dep_name} -> {flight.arr_name}")
     desc_parts = [
         f"Flight: JAL{flight.flight_no}",
         f"From: {flight.dep_name} ({dep_code}) {flight.dep_time}",
@@ -268,31 +291,31 @@ def to_ics(flight: Flight) -> str:
     ]
     if flight.seat_class or flight.seat_no:
         desc_parts.append(f"Seat: {flight.seat_class or ''} {flight.seat_no or ''}".strip())
-    description = escape_ics_text("\\n".join(desc_parts))
-    uid = f"{uuid.uuid4()}@jal-parser"
-    return (
-        "BEGIN:VEVENT\n"
-        f"UID:{uid}\n"
-        f"DTSTAMP:{dtstamp}\n"
-        f"DTSTART;TZID=Asia/Tokyo:{fmt(dep_dt)}\n"
-        f"DTEND;TZID=Asia/Tokyo:{fmt(arr_dt)}\n"
-        f"SUMMARY:{summary}\n"
-        f"LOCATION:{location}\n"
-        f"DESCRIPTION:{description}\n"
-        "END:VEVENT\n"
-    )
-
-def flights_to_ics(flights):
-    events = "".join(to_ics(f) for f in flights)
-    return (
-        "BEGIN:VCALENDAR\n"
-        "PRODID:-//JAL Flight Parser//JP\n"
-        "VERSION:2.0\n"
-        "CALSCALE:GREGORIAN\n"
-        "METHOD:PUBLISH\n"
-        f"{events}"
-        "END:VCALENDAR\n"
-    )
+    description = escape_clean_ics_text("\\n".join(desc_parts))
+    return VEVENT_TEMPLATE.format(uid, dtstamp, fmt(dep_dt), fmt(arr_dt),
+                                  summary, location, description)
+
+def build_vevents(flights) -> list[str]:
+    """DTSTAMP と UID の基数を共有した1便ごとの VEVENT を返す"""
+    dtstamp = ics_dtstamp()
+    base = uuid.uuid4().hex
+    return [to_ics(f, dtstamp, f"{base}{i:04x}@jal-parser")
+            for i, f in enumerate(flights)]
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def flights_to_ics(flights) -> str:
+    return ICS_HEADER + "".join(build_vevents(flights)) + ICS_FOOTER
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def flights_to_zip(flights) -> bytes:
+    """1便ごとのICSをまとめたZIPを返す"""
+    buf = io.BytesIO()
+    # ICSは数百バイトなので圧縮せずに格納する
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+        for f, event in zip(flights, build_vevents(flights)):
+            fname = f"JAL{f.flight_no}_{f.year:04d}{f.month:02d}{f.day:02d}.ics"
+            zf.writestr(fname, ICS_HEADER + event + ICS_FOOTER)
+    return buf.getvalue()
 
 SAMPLE = """旅程1
 2025年9月20日（土）　JAL511便
@@ -397,18 +420,16 @@ if run:
         st.error("フライト情報を検出できませんでした。")
     else:
         st.success(f"検出フライト数: {len(flights)}")
-        rows = []
-        for f in flights:
-            rows.append({
-                "Date": f"{f.year:04d}-{f.month:02d}-{f.day:02d}",
-                "Flight": f"JAL{f.flight_no}",
-                "From": f"{f.dep_name} ({f.dep_code()})",
-                "Dep": f.dep_time,
-                "To": f"{f.arr_name} ({f.arr_code()})",
-                "Arr": f.arr_time,
-                "SeatClass": f.seat_class or "",
-                "SeatNo": f.seat_no or ""
-            })
+        rows = [{
+            "Date": f"{f.year:04d}-{f.month:02d}-{f.day:02d}",
+            "Flight": f"JAL{f.flight_no}",
+            "From": f"{f.dep_name} ({f.dep_code})",
+            "Dep": f.dep_time,
+            "To": f"{f.arr_name} ({f.arr_code})",
+            "Arr": f.arr_time,
+            "SeatClass": f.seat_class or "",
+            "SeatNo": f.seat_no or ""
+        } for f in flights]
         st.dataframe(rows, use_container_width=True)
 
         ics_all = flights_to_ics(flights)
@@ -420,14 +441,9 @@ if run:
         )
 
         # ZIP 個別
-        buf = io.BytesIO()
-        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
-            for f in flights:
-                fname = f"JAL{f.flight_no}_{f.year:04d}{f.month:02d}{f.day:02d}.ics"
-                zf.writestr(fname, flights_to_ics([f]))
         st.download_button(
             "個別ICS ZIPダウンロード",
-            data=buf.getvalue(),
+            data=flights_to_zip(flights),
             file_name="jal_flights.zip",
             mime="application/zip"
         )